@@ -30,6 +30,11 @@ class Document(db.Model):
     timestamp = db.Column(db.Integer)
     parent = db.Column(db.Integer)
 
+    # metadata rows of this document (no foreign key in the schema)
+    metadata_rows = db.relationship('Metadata',
+        primaryjoin='Document.id == foreign(Metadata.document)',
+        viewonly=True)
+
     def __init__(self, type='doc', title='', author='',
                  doi='', timestamp=None, parent=None):
         if not timestamp:
@@ -74,3 +79,7 @@ class Metadata(db.Model):
 
     def __repr__(self):
         return self.key
+
+
+# lookups like get_filename filter by key and document
+db.Index('ix_metadata_key_document', Metadata.key, Metadata.document)
@@ -24,6 +24,8 @@ CREATE TABLE metadata
   PRIMARY KEY (document, key, value)
 );
 
+CREATE INDEX ix_metadata_key_document ON metadata (key, document);
+
 
 -- DB example data
 
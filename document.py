@@ -12,18 +12,31 @@
 
 from database import db, Document, Metadata
 
+import io
 import re
+import errno
 import os.path
+import collections
 import mimetypes
+import multiprocessing.pool
 
-import pdfminer
-import pdfminer.pdfparser
-import pdfminer.pdfdocument
+import PyPDF2
+import PyPDF2.utils
+import elasticsearch.helpers
+from sqlalchemy.orm import selectinload
 
 UPLOAD_FOLDER = 'data'
+READ_CHUNK_SIZE = 1 << 20
 
-DOC_COLUMNS = ['id', 'type', 'title', 'author', 'doi', 'timestamp', 'parent']
+DOC_COLUMNS = ('id', 'type', 'title', 'author', 'doi', 'timestamp', 'parent')
 METADATA_COLUMNS = ['document', 'key', 'value']
+TEXT_EXTENSIONS = frozenset(['txt', 'tex', 'rst', 'enl', 'bib'])
+PDF_FIELDS = [u'Producer', u'Creator', u'Title', u'Keywords', u'Subject']
+PDF_READ_THREADS = 32
+UNLINK_THREADS = 32
+
+# matches every non-word character, including non-ASCII ones on Python 2
+_NONWORD = re.compile(r'\W', re.UNICODE)
 
 
 def create_document(title='', author='', doi='', tags=[], **kwargs):
@@ -32,35 +45,29 @@ def create_document(title='', author='', doi='', tags=[], **kwargs):
     new_doc = Document(kwargs.get(u'type', u'doc'), title, author,
                        doi, None, kwargs.get(u'parent'))
     db.session.add(new_doc)
-    db.session.commit()  # retrieve new_doc.id
+    db.session.flush()  # retrieve new_doc.id
 
     # create new tags
-    for tag in tags:
-        if tag:
-            new_tag = Metadata(new_doc.id, u'tag', tag.strip())
-            db.session.add(new_tag)
+    db.session.add_all([Metadata(new_doc.id, u'tag', tag.strip())
+                        for tag in tags if tag])
 
     db.session.commit()
     return new_doc.id
 
 
-def retrieve_document(doc_id, with_attachments=True):
-    """Retrieve document and all associated information using `doc_id`.
-    Does not return attachments of attachment. Returns dict.
+def _document_data(doc, metadata):
+    """Build the dict representation of `doc` from its `metadata` rows.
+    Does not query the database. Returns dict.
     """
-    doc = Document.query.filter_by(id=doc_id).first()
-    metadata = Metadata.query.filter_by(document=doc_id).all()
     data = {'tags': [], 'attachments': [], 'meta': {}}
-    children = set([])
 
-    # retrieve document data
-    for field in DOC_COLUMNS:
-        data[field] = getattr(doc, field)
+    # retrieve document data, bypassing the attribute instrumentation
+    # unless `doc` has been expired and must be refreshed
+    state = doc.__dict__
+    if not all(field in state for field in DOC_COLUMNS):
+        state = dict((field, getattr(doc, field)) for field in DOC_COLUMNS)
+    data.update((field, state[field]) for field in DOC_COLUMNS)
     data['id'] = int(data['id'])
-
-    if doc.parent:
-        parent_doc = Document.query.filter_by(id=doc.parent).first()
-        data['parent_title'] = parent_doc.title
     data['format_date'] = doc.get_format_date_string()
 
     # retrieve metadata
@@ -71,27 +78,92 @@ def retrieve_document(doc_id, with_attachments=True):
         if entry.key not in data:
             data['meta'][entry.key] = entry.value
 
-    # retrieve children
-    if with_attachments:
-        children = Document.query.filter_by(parent=doc_id).all()
-        for child in children:
-            data['attachments'].append(
-                retrieve_document(child.id, with_attachments=False)
-            )
+    data['filename'] = data['meta'].get('filename')
+    return data
+
 
-    data['filename'] = get_filename(doc_id)
+def retrieve_document(doc_id, with_attachments=True):
+    """Retrieve document and all associated information using `doc_id`.
+    Does not return attachments of attachment. Returns dict.
+    """
+    doc_id = int(doc_id)
+
+    # fetch document, its parent and its children in one query
+    parent_id = db.session.query(Document.parent) \
+        .filter(Document.id == doc_id)
+    criterion = Document.id.in_([doc_id]) | Document.id.in_(parent_id)
+    if with_attachments:
+        criterion = criterion | (Document.parent == doc_id)
+    docs = Document.query.filter(criterion).order_by(Document.id).all()
+
+    doc = None
+    for d in docs:
+        if d.id == doc_id:
+            doc = d
+    if not doc:
+        return None
+
+    # fetch metadata of document and children in one query
+    ids = [d.id for d in docs if d.id != doc.parent]
+    metadata = collections.defaultdict(list)
+    for entry in Metadata.query.filter(Metadata.document.in_(ids)).all():
+        metadata[entry.document].append(entry)
+
+    data = _document_data(doc, metadata[doc.id])
+
+    for d in docs:
+        if doc.parent and d.id == doc.parent:
+            data['parent_title'] = d.title
+        elif with_attachments and d.parent == doc_id and d.id != doc_id:
+            attachment = _document_data(d, metadata[d.id])
+            attachment['parent_title'] = doc.title
+            data['attachments'].append(attachment)
 
     return data
 
 
+def retrieve_documents(docs):
+    """Retrieve information about all Document instances `docs` and their
+    attachments using two queries. Does not set parent titles.
+    Returns list of dicts.
+    """
+    ids = [doc.id for doc in docs]
+    if not ids:
+        return []
+
+    children = Document.query.filter(Document.parent.in_(ids)) \
+        .order_by(Document.id).all()
+
+    metadata = collections.defaultdict(list)
+    all_ids = ids + [child.id for child in children]
+    for entry in Metadata.query.filter(Metadata.document.in_(all_ids)).all():
+        metadata[entry.document].append(entry)
+
+    attachments = collections.defaultdict(list)
+    for child in children:
+        attachments[child.parent].append(
+            _document_data(child, metadata[child.id])
+        )
+
+    result = []
+    for doc in docs:
+        data = _document_data(doc, metadata[doc.id])
+        data['attachments'] = attachments[doc.id]
+        result.append(data)
+    return result
+
+
 def update_document(doc_id, **attributes):
     """Update document data with updated attributes. Returns None."""
-    doc = Document.query.filter_by(id=doc_id).first()
-    if doc:
-        for attr, attr_value in attributes.iteritems():
-            setattr(doc, attr, attr_value)
+    if not db.session.query(Document.id).filter_by(id=doc_id).scalar():
+        return None
+
+    if attributes:
+        db.session.execute(Document.__table__.update()
+                           .where(Document.id == doc_id)
+                           .values(**attributes))
         db.session.commit()
-        return doc_id
+    return doc_id
 
 
 def delete_document(doc_id):
@@ -100,28 +172,48 @@ def delete_document(doc_id):
         print('Cannot delete document with ID 0.')
         return
 
-    docs = set([])
-    tmp = set([doc_id])
-
-    # Retrieve set of documents related to document `doc_id` in hierarchy
-    # ... and delete them already from the Document table
-    # Using Breadth-First Search.
-    while tmp:
-        current = tmp.pop()
-        results = Document.query.filter_by(parent=current).all()
-        for result in results:
-            tmp.add(result.id)
-            db.session.delete(result)  # delete document
-        docs.add(current)
-    db.session.delete(Document.query.filter_by(id=doc_id).first())
-
-    # Remove any metadata related to documents with ID in `docs`
-    for document_id in docs:
-        mds = Metadata.query.filter_by(document=document_id).all()
-        for md in mds:
-            if md.key == 'filename':
-                os.unlink(os.path.join(UPLOAD_FOLDER, md.value))  # delete file
-            db.session.delete(md)  # delete metadata
+    # Retrieve IDs of all documents related to document `doc_id` in
+    # hierarchy using a recursive query
+    rows = db.session.execute(db.text(
+        'WITH RECURSIVE tree(id) AS ('
+        ' SELECT CAST(:root AS integer)'
+        ' UNION ALL'
+        ' SELECT d.id FROM documents d JOIN tree t ON d.parent = t.id'
+        ') SELECT id FROM tree'), {'root': int(doc_id)})
+    docs = [row[0] for row in rows]
+
+    # Collect files of documents with ID in `docs`
+    mds = Metadata.query.filter(Metadata.document.in_(docs),
+                                Metadata.key == 'filename').all()
+    paths = [os.path.join(UPLOAD_FOLDER, md.value) for md in mds]
+
+    # Remove metadata and documents with ID in `docs`
+    db.session.execute(Metadata.__table__.delete()
+                       .where(Metadata.document.in_(docs)))
+    db.session.execute(Document.__table__.delete()
+                       .where(Document.id.in_(docs)))
+    db.session.commit()
+
+    # Remove files only after the rows referencing them are gone
+    if len(paths) < 2:
+        for path in paths:
+            _unlink(path)  # delete file
+    else:
+        # overlap the per-file latency of the unlink calls
+        pool = multiprocessing.pool.ThreadPool(min(UNLINK_THREADS, len(paths)))
+        try:
+            pool.map(_unlink, paths)  # delete files
+        finally:
+            pool.close()
+
+
+def _unlink(path):
+    """Delete file at `path`, if it exists. Returns None."""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
 
 
 def create_attachment(parent, title="", author="", doi='', tags=[]):
@@ -133,16 +225,9 @@ def create_attachment(parent, title="", author="", doi='', tags=[]):
 
 def get_filename(doc_id):
     """Retrieve the filename of document with id=`doc_id`"""
-
     md = Metadata.query.filter_by(key='filename', document=doc_id).first()
-    print(doc_id, md)
     if md:
         return md.value
-
-    for filename in os.listdir(UPLOAD_FOLDER):
-        if filename.startswith(str(doc_id) + '.'):
-            return filename
-
     return None
 
 
@@ -153,10 +238,12 @@ def _add_metadata_row(doc_id, key, value):
         db.session.add(row)
 
 
-def upload_doc(es, filepath, doc_id):
+def upload_doc(es, filepath, doc_id, defer=None):
     """Take document from filepath and store it according to `doc_id`
-    so we can retrieve it later. Also register at search engine and
-    retrieve further metadata from the document. Returns new filename.
+    so we can retrieve it later. Registering at the search engine and
+    retrieving further metadata is done by `process_upload`, which is
+    handed to `defer` (if given) to run it outside of the request.
+    Returns new filename.
     """
     # retrieve file extension & mime type
     if '.' in filepath.filename:
@@ -164,10 +251,7 @@ def upload_doc(es, filepath, doc_id):
     else:
         fileext = str(doc_id)
 
-    try:
-        mimetype = mimetypes.types_map['.' + fileext]
-    except KeyError:
-        mimetype = None
+    mimetype = mimetypes.types_map.get('.' + fileext)
 
     new_filename = str(doc_id) + '.' + fileext
     file_path = os.path.join(UPLOAD_FOLDER, new_filename)
@@ -184,59 +268,193 @@ def upload_doc(es, filepath, doc_id):
         mimetype_row = Metadata(doc_id, u'mimetype', mimetype)
         db.session.add(mimetype_row)
 
-    # retrieve metadata using pdfminer, if PDF
+    db.session.commit()
+
+    args = (doc_id, new_filename, mimetype, filepath.filename)
+    if defer:
+        defer(*args)
+    else:
+        process_upload(es, *args)
+
+    return new_filename
+
+
+def process_upload(es, doc_id, filename, mimetype, orig_filename):
+    """Retrieve further metadata from the uploaded file `filename` of
+    document `doc_id` and register it at the search engine. Returns None.
+    """
+    fileext = filename.rsplit('.', 1)[1]
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+
+    # collect all search engine fields to submit them in one request
+    index_body = {'doc': {
+        'filename': filename,
+        'mimetype': mimetype,
+        'orig_filename': orig_filename
+    }, 'doc_as_upsert': True}
+
+    # retrieve metadata using PyPDF2, if PDF
     if mimetype == 'application/pdf':
-        with open(file_path, 'rb') as fp:
-            parser = pdfminer.pdfparser.PDFParser(fp)
-            doc = pdfminer.pdfdocument.PDFDocument(parser)
-            parser.set_document(doc)
-            doc.initialize()
-
-            fields = [u'Producer', u'Creator', u'Title',
-                      u'Keywords', u'Subject']
-            for key in fields:
-                try:
-                    keyname = u'pdf.' + key.lower()
-                    try:
-                        value = str(doc.info[0][key])
-                    except UnicodeDecodeError:
-                        continue
-                    _add_metadata_row(doc_id, keyname, value)
-                    es.update(index="knuth", doc_type="document",
-                        id=doc_id, body={'doc': {'meta': {keyname: value}}})
-                except KeyError:
-                    pass
+        for keyname, value in read_pdf_info(file_path).items():
+            _add_metadata_row(doc_id, keyname, value)
+            index_body['doc'].setdefault('meta', {})[keyname] = value
 
     # add content to search engine, if plain text
-    if fileext in ['txt', 'tex', 'rst', 'enl', 'bib']:
-        with open(file_path, 'r') as fp:
-            content = fp.read().decode('utf-8')
-            content = re.sub('\W', ' ', content).encode('utf-8')
-            es.update(index="knuth", doc_type="document",
-                id=doc_id, body={'doc': {'content': content}})
-
-    # add metadata to search engine
-    if es.exists(index="knuth", id=doc_id):
-        es.update(index="knuth", doc_type="document",
-            id=doc_id, body={'doc': {
-                'filename': new_filename,
-                'mimetype': mimetype,
-                'orig_filename': filepath.filename
-            }})
+    if fileext in TEXT_EXTENSIONS:
+        content = io.StringIO()
+        with io.open(file_path, 'r', encoding='utf-8',
+                     buffering=READ_CHUNK_SIZE) as fp:
+            for chunk in iter(lambda: fp.read(READ_CHUNK_SIZE), u''):
+                content.write(_NONWORD.sub(u' ', chunk))
+        index_body['doc']['content'] = content.getvalue()
 
     db.session.commit()
 
-    return new_filename
+    # add metadata and content to search engine
+    es.update(index="knuth", doc_type="document",
+        id=doc_id, body=index_body)
+
+
+def read_pdf_info(file_path):
+    """Read the document information of the PDF at `file_path`.
+    Returns dict mapping metadata keys to values, which is empty if the
+    file cannot be read.
+    """
+    try:
+        return _read_pdf_info(file_path)
+    except (IOError, NotImplementedError, PyPDF2.utils.PdfReadError):
+        # unreadable PDF: only its pdf.* fields are lost
+        return {}
+
+
+def _read_pdf_info(file_path):
+    """Like `read_pdf_info`, but raises if the file cannot be read"""
+    result = {}
+    with open(file_path, 'rb') as fp:
+        # only reads the trailer's /Info dictionary, not the pages
+        reader = PyPDF2.PdfFileReader(fp, strict=False)
+        if reader.isEncrypted:
+            reader.decrypt('')  # default user password
+        info = reader.getDocumentInfo()
+
+        for key in PDF_FIELDS:
+            try:
+                value = _pdf_text(info[u'/' + key])
+            except (KeyError, TypeError):
+                continue
+            if value:
+                result[u'pdf.' + key.lower()] = value
+    return result
+
+
+def _pdf_text(value):
+    """Convert a PDF string object to text"""
+    if isinstance(value, bytes):
+        # ByteStringObject: neither PDFDocEncoding nor UTF-16
+        return value.decode('utf-8', 'replace')
+    return u'%s' % (value,)
+
+
+def reimport_pdf_metadata(es, threads=PDF_READ_THREADS):
+    """Read the metadata of all uploaded PDFs again, using `threads`
+    concurrent readers, and store it in the database and search engine.
+    Returns number of PDFs read.
+    """
+    pdf_docs = db.session.query(Metadata.document) \
+        .filter_by(key=u'mimetype', value=u'application/pdf')
+    rows = Metadata.query.filter(Metadata.key == u'filename',
+                                 Metadata.value.like(u'%.pdf'),
+                                 Metadata.document.in_(pdf_docs)).all()
+    if not rows:
+        return 0
+
+    # overlap the per-file I/O latency of opening and reading the PDFs
+    paths = [os.path.join(UPLOAD_FOLDER, row.value) for row in rows]
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        infos = pool.map(_try_read_pdf_info, paths)
+    finally:
+        pool.close()
+
+    # skip documents whose file could not be read
+    read = [(row.document, info) for row, info in zip(rows, infos)
+            if info is not None]
+    if not read:
+        return 0
+
+    # replace previously extracted metadata
+    ids = [doc_id for doc_id, info in read]
+    db.session.execute(Metadata.__table__.delete()
+                       .where(Metadata.document.in_(ids))
+                       .where(Metadata.key.like(u'pdf.%')))
+    for doc_id, info in read:
+        for keyname, value in info.items():
+            _add_metadata_row(doc_id, keyname, value)
+    db.session.commit()
+
+    # rebuild the search engine documents, so keys that are no longer
+    # extracted disappear from the index as well
+    index_documents(es, ids)
+    return len(read)
+
+
+def _try_read_pdf_info(file_path):
+    """Like `read_pdf_info`, but returns None if `file_path` cannot be
+    read, so one bad file neither aborts a whole batch nor loses the
+    metadata stored for it.
+    """
+    try:
+        return _read_pdf_info(file_path)
+    except (IOError, NotImplementedError, PyPDF2.utils.PdfReadError):
+        return None
 
 
 def index_document_by_id(es, doc_id):
-    doc = Document.query.filter_by(id=doc_id).first()
-    meta = Metadata.query.filter_by(document=doc_id).all()
+    doc = Document.query.options(selectinload(Document.metadata_rows)) \
+        .get(doc_id)
 
-    return index_document(es, doc, meta)
+    return index_document(es, doc, doc.metadata_rows)
 
 
-def index_document(es, document, metadata):
+def index_documents(es, doc_ids):
+    """Index all documents with ID in `doc_ids` using one bulk request.
+    Returns tuple (number of indexed documents, errors).
+    """
+    docs = Document.query.filter(Document.id.in_(doc_ids)) \
+        .options(selectinload(Document.metadata_rows)).all()
+
+    actions = [_index_action(doc) for doc in docs]
+    return elasticsearch.helpers.bulk(es, actions, chunk_size=100)
+
+
+def reindex_all(es, batch=500, thread_count=4):
+    """Index all documents in the database using parallel bulk requests
+    of `batch` documents each. Returns number of indexed documents.
+    """
+    docs = Document.query.options(selectinload(Document.metadata_rows)) \
+        .yield_per(batch)
+    actions = (_index_action(doc) for doc in docs)
+
+    count = 0
+    for ok, info in elasticsearch.helpers.parallel_bulk(es, actions,
+            thread_count=thread_count, chunk_size=batch):
+        count += 1
+    return count
+
+
+def _index_action(document):
+    """Build a bulk index action for `document`"""
+    return {
+        '_op_type': 'index',
+        '_index': 'knuth',
+        '_type': 'document',
+        '_id': document.id,
+        '_source': _index_body(document, document.metadata_rows)
+    }
+
+
+def _index_body(document, metadata):
+    """Build the search engine representation of `document`"""
     meta = {}
     tags = []
 
@@ -255,6 +473,15 @@ def index_document(es, document, metadata):
     index_body['meta'] = meta
     index_body['tags'] = tags
 
+    # top-level fields as set by process_upload
+    for key in ('filename', 'mimetype'):
+        if key in meta:
+            index_body[key] = meta[key]
+    return index_body
+
+
+def index_document(es, document, metadata):
+    index_body = _index_body(document, metadata)
     res = es.index(index='knuth', doc_type='document',
                    id=document.id, body=index_body)
     return res
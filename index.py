@@ -22,6 +22,9 @@ from database import db
 import os.path
 import document
 import datetime
+import redis
+import redis.exceptions
+import rq
 import feedparser
 import collections
 import elasticsearch
@@ -29,6 +32,7 @@ import elasticsearch
 # setup
 FEED_TITLE = 'Newest Uploads'
 FEED_NUM_DOCUMENTS = 5
+LIST_NUM_DOCUMENTS = 50
 
 es = elasticsearch.Elasticsearch()
 app = Flask(__name__)
@@ -38,12 +42,36 @@ app.config['SQLALCHEMY_DATABASE_URI'] = DB_URI
 
 db.init_app(app)
 
+# background jobs, processed by `rq worker knuth`
+queue = rq.Queue('knuth', connection=redis.Redis())
+
 FEED_BODY = u'''Title: {title:}<br />
 Author: {author:}<br />
 DOI: {doi:}<br />
 Upload: {upload:}'''
 
 
+def process_upload(*args):
+    """Background job processing an uploaded file.
+    See `document.process_upload`.
+    """
+    with app.app_context():
+        document.process_upload(es, *args)
+
+
+def defer_upload(*args):
+    """Enqueue processing of an uploaded file for the background worker.
+    Processes it within the request if the queue is unavailable.
+    """
+    try:
+        # referenced by name, so the job also resolves if run as __main__
+        queue.enqueue('index.process_upload', *args)
+    except redis.exceptions.RedisError as e:
+        app.logger.warning('Cannot enqueue upload (%s), processing it '
+                           'within the request', e)
+        document.process_upload(es, *args)
+
+
 # routing
 @app.route('/faq')
 def faq():
@@ -117,7 +145,8 @@ def create():
             doc_id = data['id']
 
         if data['doc']:
-            filename = document.upload_doc(es, data['doc'], doc_id)
+            filename = document.upload_doc(es, data['doc'], doc_id,
+                                           defer=defer_upload)
         else:
             filename = document.get_filename(doc_id)
 
@@ -129,7 +158,8 @@ def create():
                     data['attachment']['doi'],
                     data['tags'])
             document.index_document_by_id(es, at)
-            attach = document.upload_doc(es, data['attachment']['doc'], at)
+            attach = document.upload_doc(es, data['attachment']['doc'], at,
+                                         defer=defer_upload)
 
         docu = document.retrieve_document(doc_id)
     else:
@@ -146,18 +176,18 @@ def create():
 
 @app.route('/browse')
 @app.route('/list')
-def listing(page=0):
+def listing():
     """Create a list of all available documents"""
-    # 1. request all documents from DB
-    documents = Document.query.order_by(Document.timestamp.desc()).all()
-    all_docs = []
-
-    for doc in documents:
-        all_docs.append(document.retrieve_document(doc.id))
+    # 1. request current page of documents from DB
+    page = request.args.get('page', 1, type=int)
+    pagination = Document.query \
+        .order_by(Document.timestamp.desc(), Document.id.desc()) \
+        .paginate(page=page, per_page=LIST_NUM_DOCUMENTS, error_out=False)
 
     # 2. provide data to template engine
     return render_template('list.html',
-        documents=all_docs, page='listing'
+        documents=document.retrieve_documents(pagination.items),
+        pagination=pagination, page='listing'
     )
 
 
@@ -255,11 +285,9 @@ def main():
 
         for hit in hits:
             document_id = hit['_id']
-            d = Document.query.filter_by(id=document_id).first()
+            d = Document.query.get(int(document_id))
             results[str(document_id)] = d
 
-    print results
-
     tmpl_params = {'results': results, 'page': 'listresults'}
     return render_template('listresults.html', **tmpl_params)
 